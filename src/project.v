@@ -43,7 +43,7 @@ module tt_um_sanojn_ttrpg_dice_ihp (
     debouncer Btn20_deb (.clk(clk), .rst_n(rst_sync), .tick(tick), .button(button[5]), .debounced(btn20));
     debouncer Btn100_deb(.clk(clk), .rst_n(rst_sync), .tick(tick), .button(button[6]), .debounced(btn100));
     
-    wire anybtn;
+    (* keep *) wire anybtn;
     assign anybtn = btn4 | btn6 | btn8 | btn10 | btn12 | btn20 | btn100;
     
     (* keep *) reg [3:0] digit1, digit10;
@@ -71,7 +71,7 @@ module tt_um_sanojn_ttrpg_dice_ihp (
         end
 
     // Turn off digit outputs after ~8 seconds
-    wire showDigitTimeout;
+    (* keep *) wire showDigitTimeout;
     reg [7:0] timeoutCounter;
     always @(posedge clk) begin
         if (rst_sync==0) begin
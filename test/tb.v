@@ -23,6 +23,11 @@ module tb ();
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
 
+  // Free running clock, generated here rather than from cocotb so that
+  // the simulator doesn't call back into Python on every clock edge
+  initial clk = 1'b0;
+  always #15000 clk = ~clk; // 30 us period, approximation of 32768 Hz
+
   tt_um_sanojn_ttrpg_dice_ihp user_project (
 
       // Include power ports for the Gate Level test:
@@ -109,6 +114,12 @@ module tb ();
      assign digit10 = user_project.digit10;
   `endif
 
+   // The debounced button state and the display timeout decide when the display is lit.
+   // They are single kept nets, so they have the same names in the gate level netlist
+   wire anyButtonDebounced, showDigitTimeout;
+   assign anyButtonDebounced = user_project.anybtn;
+   assign showDigitTimeout   = user_project.showDigitTimeout;
+
 
    //////////////////////////////////////////////////////////
    // Excercising the I2C slave
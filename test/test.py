@@ -2,101 +2,152 @@
 # SPDX-License-Identifier: MIT
 
 import cocotb
-from cocotb.clock import Clock
 from cocotb.triggers import ClockCycles
 from cocotb.triggers import RisingEdge
+from cocotb.triggers import FallingEdge
 from cocotb.triggers import Trigger
 from cocotb.triggers import Edge
 from cocotb.triggers import Timer
+from cocotb.triggers import ReadOnly
+from cocotb.triggers import First
+
+CLK_PERIOD_US = 30 # Period of the clock generated in tb.v
 
 def hex(n): # Return a binary octet with 2 BCD digits
   return ((n%100)//10)*16 + n%10;
 
-def internalDigits(dut): # Return the two internal digit counters as an octet
-  return dut.digit10.value*16 + dut.digit1.value
+_BCD = [hex(n) for n in range(101)] # hex(n) precomputed for the counter range 0..100
+
+def internalDigits(d10, d1): # Return the two internal digit counters as an octet
+  return d10.value*16 + d1.value
+
+async def waitTick(tick): # Wait for the next tick, but fail rather than hang if it never comes
+  # A tick is expected every 1024 clock cycles (~31 ms)
+  result = await First(RisingEdge(tick), Timer(100, units='ms'))
+  assert isinstance(result, RisingEdge), "tick did not fire"
+
+_buttons = None # Button handles, looked up on first use
 
 def releaseButtons(dut):
-    dut.btn4.value = 0;
-    dut.btn6.value = 0;
-    dut.btn8.value = 0;
-    dut.btn10.value = 0;
-    dut.btn12.value = 0;
-    dut.btn20.value = 0;
-    dut.btn100.value = 0;
-
-async def testCycle(dut,period):
+    global _buttons
+    if _buttons is None:
+      _buttons = (dut.btn4, dut.btn6, dut.btn8, dut.btn10, dut.btn12, dut.btn20, dut.btn100)
+    for btn in _buttons:
+      btn.value = 0;
+
+async def waitDeglitch(dut, tick): # Wait until the debouncers have had time to accept a button press
     await ClockCycles(dut.clk, 1, False) # allow for synch delay
     # allow input to be deglitched
-    while (dut.user_project.tick.value==0):
-      await ClockCycles(dut.clk,1,False)
+    if (tick.value==0):
+      await waitTick(tick)
+      await ClockCycles(dut.clk,1,False) # realign to the falling clock edge
     await ClockCycles(dut.clk,1,False)
-    while (dut.user_project.tick.value==0):
-      await ClockCycles(dut.clk,1,False)
+    if (tick.value==0): # tick is still high here right after reset, while the prescaler is held
+      await waitTick(tick)
+      await ClockCycles(dut.clk,1,False) # realign to the falling clock edge
     await ClockCycles(dut.clk, 1, False) # Let the debounce FSM see the tick
-    # Now the counter should be rolling
+
+async def testNoButton(dut):
+    tick = dut.user_project.tick
+    d1 = dut.digit1
+    d10 = dut.digit10
+    await waitDeglitch(dut, tick)
+    # With no button pressed, the counter should stay at 1
+    clkFalling = FallingEdge(dut.clk)
+    for i in range(0,5):
+      await clkFalling
+      assert internalDigits(d10, d1) == _BCD[1]
+
+async def testCycle(dut,period): # Only for period > 1, use testNoButton when no button is pressed
+    # Look up the handles once, they are used on every clock cycle below
+    tick = dut.user_project.tick
+    d1 = dut.digit1
+    d10 = dut.digit10
+    await waitDeglitch(dut, tick)
+    # Now the counter should be rolling, one step per clock cycle
+    # One reusable trigger per step avoids the ClockCycles wrapper in the loops below
+    clkFalling = FallingEdge(dut.clk)
     # Wait until it's 1 to simplify tests
-    if (internalDigits(dut)!=hex(1)):
+    if (internalDigits(d10, d1)!=_BCD[1]):
       for i in range(0,period):
-        await ClockCycles(dut.clk, 1, False)
-        if (internalDigits(dut)==hex(1)):
+        await clkFalling
+        if (internalDigits(d10, d1)==_BCD[1]):
           break;
     # Check one period
     for i in range(period,0,-1):
-      await ClockCycles(dut.clk, 1, False)
-      assert internalDigits(dut) == hex(i)
+      await clkFalling
+      assert internalDigits(d10, d1) == _BCD[i]
     # Check one more period
     for i in range(period,0,-1):
-      await ClockCycles(dut.clk, 1, False)
-      assert internalDigits(dut) == hex(i)
+      await clkFalling
+      assert internalDigits(d10, d1) == _BCD[i]
     # Multiple cycles
-    await ClockCycles(dut.clk, 3*period, False)
-    assert internalDigits(dut) == hex(1)
-    # Run the last part only if we're actually pressing a button
-    if (period!=1):
-      # Release button and verify that counting stops
-      releaseButtons(dut);
-      await ClockCycles(dut.clk,1,False) # Allow for synch delay
-      assert internalDigits(dut) == hex(period) # Counter should have rolled over 
-      await ClockCycles(dut.clk,1,False)
-      assert internalDigits(dut) == hex(period-1) # The debouncer changes state as we roll down once more
-      await ClockCycles(dut.clk,1,False)
-      assert internalDigits(dut) == hex(period-1) # The counter should have stopped now
-      await RisingEdge(dut.user_project.tick)  # Wait a while so the debouncer knows the button is released
-      assert internalDigits(dut) == hex(period-1) # Verify that the counter hasn't moved
-      await ClockCycles(dut.clk, 7, False)
-      assert internalDigits(dut) == hex(period-1) # Verify that the counter hasn't moved
-
-def noDigitsShown(dut): # Check if the 'common' signal of both displays are off
-  return ( not dut.digit1_active.value and not dut.digit10_active.value )
+    # Same as ClockCycles(dut.clk, 3*period, False), but in two waits: a Timer to a quarter period
+    # past the second to last falling edge, away from any clock edge, and then the last falling edge
+    await Timer((3*period-1)*CLK_PERIOD_US*1000 + CLK_PERIOD_US*250, units='ns')
+    await clkFalling
+    assert internalDigits(d10, d1) == _BCD[1]
+    # Release button and verify that counting stops
+    releaseButtons(dut);
+    await ClockCycles(dut.clk,1,False) # Allow for synch delay
+    assert internalDigits(d10, d1) == _BCD[period] # Counter should have rolled over 
+    await ClockCycles(dut.clk,1,False)
+    assert internalDigits(d10, d1) == _BCD[period-1] # The debouncer changes state as we roll down once more
+    await ClockCycles(dut.clk,1,False)
+    assert internalDigits(d10, d1) == _BCD[period-1] # The counter should have stopped now
+    await waitTick(tick)  # Wait a while so the debouncer knows the button is released
+    assert internalDigits(d10, d1) == _BCD[period-1] # Verify that the counter hasn't moved
+    await ClockCycles(dut.clk, 7, False)
+    assert internalDigits(d10, d1) == _BCD[period-1] # Verify that the counter hasn't moved
+
+def noDigitsShown(d1_active, d10_active): # Check if the 'common' signal of both displays are off
+  return ( not d1_active.value and not d10_active.value )
+
+async def digitShown(clk, d1_active, d10_active): # Check that some digit is shown, sampled when all signals are stable
+  await ReadOnly();
+  if noDigitsShown(d1_active, d10_active): # if no digit is shown, maybe this a blanked digit10. Look again in the other clock phase
+    await Edge(clk);
+    await ReadOnly();
+  return not noDigitsShown(d1_active, d10_active)
 
 async def checkDigitsShown(dut):
-   while (dut.anyButtonPressed.value==1): # some button is pressed, We shouldn't see any digits
-     await Timer(1, units='ms');
-     if (dut.anyButtonPressed.value==1): # Check that button wasn't released before looking at the digit
-       assert noDigitsShown(dut);
-   while (not dut.anyButtonPressed.value==1): # no button is pressed, something should be shown on the display
-     await Timer(1, units='ms');
-     if (not dut.anyButtonPressed.value==1):
-         if noDigitsShown(dut):  # if no digit is shown, maybe this a blanked digit10. Wait for the other digit
-             await Edge(dut.clk);
-             await Timer(1, units='us');
-             assert not noDigitsShown(dut);
+   # Follow the debounced buttons and the display timeout of the design rather than the raw buttons.
+   # The display only goes dark once the debouncers have accepted a press, up to two ticks late,
+   # and it is also dark after reset and when the timeout has expired
+   anyButtonDebounced = dut.anyButtonDebounced
+   showDigitTimeout = dut.showDigitTimeout
+   d1_active = dut.digit1_active
+   d10_active = dut.digit10_active
+   await RisingEdge(dut.clk)
+   while True:
+     await ReadOnly();
+     # Both signals change on the rising clock edge, so clk is high here and digit1 is never blanked.
+     # The expected state is read at the time of the check, so a change during a wait is not missed
+     if (anyButtonDebounced.value==1 or showDigitTimeout.value==0): # We shouldn't see any digits
+       assert noDigitsShown(d1_active, d10_active);
+     else: # something should be shown on the display
+       assert not noDigitsShown(d1_active, d10_active);
+     await First(Edge(anyButtonDebounced), Edge(showDigitTimeout));
 
 async def checkSegmentOutputs(dut):
-  await Edge(dut.shownDigit);
-  assert dut.shownDigit.value != 14;
-  if (dut.digit1_active.value):
-    assert dut.shownDigit.value == dut.digit1.value;
-  elif (dut.digit10_active.value):
-    assert dut.shownDigit.value == dut.digit10.value;
-  else:
-    assert dut.digit10.value==0;
+  # Check every digit shown until the task is killed
+  while True:
+    await Edge(dut.shownDigit);
+    assert dut.shownDigit.value != 14;
+    if (dut.digit1_active.value):
+      assert dut.shownDigit.value == dut.digit1.value;
+    elif (dut.digit10_active.value):
+      assert dut.shownDigit.value == dut.digit10.value;
+    elif (dut.anyButtonDebounced.value==0 and dut.showDigitTimeout.value==1 and dut.clk.value==0):
+      assert dut.digit10.value==0; # the display is enabled, but digit10 is blanked when zero
+    else:
+      assert dut.shownDigit.value == 15; # the display is off, no segments should be lit
   
 
 async def testAllButtons(dut):
   dut._log.info("Testing no button")
   releaseButtons(dut)
-  await testCycle(dut,1)
+  await testNoButton(dut)
   dut._log.info("Testing btn4")
   dut.btn4.value = 1
   await testCycle(dut,4)
@@ -126,107 +177,64 @@ async def reset(dut):
   releaseButtons(dut)
   await ClockCycles(dut.clk, 10, False)
   dut.rst_n.value = 1
-  assert internalDigits(dut) == hex(1)
+  assert internalDigits(dut.digit10, dut.digit1) == hex(1)
 
 #############################################################################
 #### Tests begin here #######################################################
 
-@cocotb.test()
-async def test_dice_activehighbuttons(dut):
-  dut._log.info("Testing active high buttons")
-  dut._log.info("Setting up test")
-  clock = Clock(dut.clk, 30, units="us") # Approximation of 32768 Hz
-  cocotb.start_soon(clock.start())
-  dut.cfg.value = 1 # Configure buttons as active high, outputs as active low
-  await reset(dut)
-  digitsShown_task = cocotb.start_soon(checkDigitsShown(dut))
-  segmentsShown_task = cocotb.start_soon(checkSegmentOutputs(dut))
-  dut._log.info("Running test")
-  await testAllButtons(dut)
-  dut._log.info("End test")
-
-@cocotb.test()
-async def test_dice_activelowbuttons(dut):
-  dut._log.info("Testing active low buttons")
-  dut._log.info("Setting up test")
-  clock = Clock(dut.clk, 30, units="us") # Approximation of 32768 Hz
-  cocotb.start_soon(clock.start())
-  dut.cfg.value = 0 # Configure buttons as active low, outputs as active low
-  activeLevel=0
-  commonLevel=0
-  await reset(dut)
-  digitsShown_task = cocotb.start_soon(checkDigitsShown(dut))
-  segmentsShown_task = cocotb.start_soon(checkSegmentOutputs(dut))
-  dut._log.info("Running test")
-  await testAllButtons(dut)
-  dut._log.info("End test")
-
-@cocotb.test()
-async def test_dice_activehighsegments(dut):
-  dut._log.info("Testing active high segment outputs")
-  dut._log.info("Setting up test")
-  clock = Clock(dut.clk, 30, units="us") # Approximation of 32768 Hz
-  cocotb.start_soon(clock.start())
-  dut.cfg.value = 2+1 # Configure buttons as active high, segment outputs as active high
-  await reset(dut)
-  digitsShown_task = cocotb.start_soon(checkDigitsShown(dut))
-  segmentsShown_task = cocotb.start_soon(checkSegmentOutputs(dut))
-  dut._log.info("Running test")
-  await testAllButtons(dut)
-  dut._log.info("End test")
-  
-@cocotb.test()
-async def test_dice_activehighcommons(dut):
-  dut._log.info("Testing active high common outputs")
-  dut._log.info("Setting up test")
-  clock = Clock(dut.clk, 30, units="us") # Approximation of 32768 Hz
-  cocotb.start_soon(clock.start())
-  dut.cfg.value = 4+1 # Configure buttons as active high, common outputs as active high
-  await reset(dut)
-  digitsShown_task = cocotb.start_soon(checkDigitsShown(dut))
-  segmentsShown_task = cocotb.start_soon(checkSegmentOutputs(dut))
-  dut._log.info("Running test")
-  await testAllButtons(dut)
-  dut._log.info("End test")
+# Button and output polarity configurations, all run by test_dice_all_configs
+diceConfigs = (
+  (1,     "active high buttons"), # Configure buttons as active high, outputs as active low
+  (0,     "active low buttons"), # Configure buttons as active low, outputs as active low
+  (2+1,   "active high segment outputs"), # Configure buttons as active high, segment outputs as active high
+  (4+1,   "active high common outputs"), # Configure buttons as active high, common outputs as active high
+  (4+2+1, "active high common and segment outputs"), # Configure buttons as active high, common and segment outputs as active high
+)
+
+async def inConfig(coro, cfg, description): # Name the configuration in any assertion failure from coro
+  try:
+    return await coro
+  except AssertionError as e:
+    raise AssertionError("cfg=" + str(cfg) + " (" + description + "): " + str(e)) from e
 
 @cocotb.test()
-async def test_dice_activehighboth(dut):
-  dut._log.info("Testing active high common and segment outputs")
-  dut._log.info("Setting up test")
-  clock = Clock(dut.clk, 30, units="us") # Approximation of 32768 Hz
-  cocotb.start_soon(clock.start())
-  dut.cfg.value = 4+2+1 # Configure buttons as active high, common and segment outputs as active high
-  await reset(dut)
-  digitsShown_task = cocotb.start_soon(checkDigitsShown(dut))
-  segmentsShown_task = cocotb.start_soon(checkSegmentOutputs(dut))
-  dut._log.info("Running test")
-  await testAllButtons(dut)
-  dut._log.info("End test")
+async def test_dice_all_configs(dut):
+  # All configurations are run in one test, resetting in between, to avoid repeating the test setup
+  for cfg, description in diceConfigs:
+    dut._log.info("Testing " + description + " (cfg=" + str(cfg) + ")")
+    dut._log.info("Setting up test")
+    dut.cfg.value = cfg
+    await reset(dut)
+    digitsShown_task = cocotb.start_soon(inConfig(checkDigitsShown(dut), cfg, description))
+    segmentsShown_task = cocotb.start_soon(inConfig(checkSegmentOutputs(dut), cfg, description))
+    dut._log.info("Running test")
+    await inConfig(testAllButtons(dut), cfg, description)
+    # Stop the monitors before the next configuration resets the design
+    digitsShown_task.kill()
+    segmentsShown_task.kill()
+    dut._log.info("End test")
 
 @cocotb.test()
 async def test_dice_timeout(dut):
   dut._log.info("Testing timeout after button release")
   dut._log.info("Setting up test")
-  clock = Clock(dut.clk, 30, units="us") # Approximation of 32768 Hz
-  cocotb.start_soon(clock.start())
   dut.cfg.value = 4+2+1 # Configure buttons as active high, common and segment outputs as active high
   await reset(dut)
+  d1_active = dut.digit1_active
+  d10_active = dut.digit10_active
   dut._log.info("Running test")
   dut._log.info("Pressing button")
   dut.btn100.value = 1
   await Timer(1, units='sec')
-  assert noDigitsShown(dut);
+  assert noDigitsShown(d1_active, d10_active);
   dut._log.info("Releasing button")
   dut.btn100.value = 0
-  for i in range(0,4):
-    await Timer(1, units='sec')
-    # Digits should be shown now
-    if noDigitsShown(dut):  # if no digit is shown, maybe this a blanked digit10. Wait for the other digit
-      await Edge(dut.clk);
-      await Timer(1, units='us');
-      assert not noDigitsShown(dut);
+  # Nothing changes until the timeout expires, so one check at the end of the display window is enough
+  await Timer(4, units='sec')
+  # Digits should be shown now
+  assert await digitShown(dut.clk, d1_active, d10_active);
   # Let the timeout expire
   await Timer(6,units='sec')
-  assert noDigitsShown(dut);
+  assert noDigitsShown(d1_active, d10_active);
   
   dut._log.info("End test")